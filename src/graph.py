@@ -21,10 +21,18 @@ if not backend_set:
     # Usar el backend por defecto si todos fallan
     print("Usando backend por defecto de matplotlib")
 import matplotlib.pyplot as plt
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+# scipy es opcional: si está disponible, el filtro IIR usa lfilter (implementado en C)
+# Si no, se usa una implementación propia con NumPy, vectorizada entre sensores
+try:
+    from scipy.signal import lfilter
+except ImportError:
+    lfilter = None
 from collections import deque
 import time
 import csv
-from datetime import datetime
+from datetime import datetime, timedelta
 import os
 import sys
 import tkinter as tk
@@ -35,6 +43,34 @@ SERIAL_BAUD = 115200
 READ_TIMEOUT = 1.0  # timeout de lectura en segundos
 RECONNECT_DELAY = 2.0  # tiempo de espera antes de reconectar
 
+# Configuración del filtrado en el host
+# Etapas disponibles (se aplican en el orden indicado): 'outliers', 'median', 'butterworth', 'kalman'
+# Con una lista vacía solo se reemplazan las lecturas inválidas por la última válida
+FILTER_CHAIN = ['outliers', 'butterworth']
+FILTER_SAMPLE_RATE_HZ = 40.0  # frecuencia de muestreo del firmware (delay(25) en main.cpp)
+FILTER_BLOCK_MAX = 64  # máximo de líneas leídas del puerto y filtradas de una sola vez
+MAX_VALID_READING_MM = 8200  # lecturas iguales a 0 o mayores a este valor son inválidas
+SENSOR_NOISE_MM = 3.0  # desviación del ruido del VL53L0X
+# Oscilación típica: el suavizado se ajusta para ella, donde el ruido del sensor es comparable
+# a la amplitud (validado de 0.5 a 2 Hz y de 2 a 10 mm, ruido de 3 mm). Oscilaciones más
+# rápidas o más amplias se grafican con retardo; en ese caso sube estos valores
+SIGNAL_TYPICAL_FREQ_HZ = 2.0
+SIGNAL_TYPICAL_AMPLITUDE_MM = 10.0
+# Oscilación máxima: el detector de atípicos nunca debe descartar muestras válidas hasta aquí
+SIGNAL_MAX_FREQ_HZ = 5.0
+SIGNAL_MAX_AMPLITUDE_MM = 50.0
+# Máximo cambio entre muestras consecutivas: pendiente máxima de la senoidal (ω·A·dt)
+# más un margen de 4 desviaciones del ruido de la diferencia entre dos muestras
+OUTLIER_MAX_STEP_MM = (2 * np.pi * SIGNAL_MAX_FREQ_HZ * SIGNAL_MAX_AMPLITUDE_MM / FILTER_SAMPLE_RATE_HZ
+                       + 4.0 * np.sqrt(2.0) * SENSOR_NOISE_MM)
+MEDIAN_WINDOW = 3  # ventana del filtro de mediana (muestras)
+# Frecuencia de corte del pasa-bajas Butterworth de 2º orden
+BUTTERWORTH_CUTOFF_HZ = 4.0 * SIGNAL_TYPICAL_FREQ_HZ
+# Desviación de la aceleración del modelo (mm/s^2): aceleración de la oscilación típica (ω²·A)
+KALMAN_PROCESS_NOISE = (2 * np.pi * SIGNAL_TYPICAL_FREQ_HZ) ** 2 * SIGNAL_TYPICAL_AMPLITUDE_MM
+KALMAN_MEASUREMENT_NOISE = SENSOR_NOISE_MM  # desviación del ruido de medición (mm)
+PLOT_RAW = False  # graficar también la señal sin filtrar
+
 ser = None
 csv_file = None
 csv_writer = None
@@ -200,7 +236,8 @@ try:
     csv_file = open(csv_filename, 'w', newline='', encoding='utf-8')
     csv_writer = csv.writer(csv_file)
     # Escribir encabezados
-    csv_writer.writerow(['Timestamp', 'Sensor1_mm', 'Sensor2_mm', 'Estado'])
+    csv_writer.writerow(['Timestamp', 'Sensor1_mm', 'Sensor2_mm', 'Estado',
+                         'Sensor1_filtrado_mm', 'Sensor2_filtrado_mm'])
     csv_file.flush()  # Asegurar que se escriba el header
     print(f"Archivo CSV creado: {csv_filename}")
 except Exception as e:
@@ -214,11 +251,169 @@ def log_to_csv(sensor1, sensor2, estado):
     if csv_writer is not None:
         try:
             timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
-            csv_writer.writerow([timestamp, f"{sensor1:.1f}", f"{sensor2:.1f}", estado])
+            csv_writer.writerow([timestamp, f"{sensor1:.1f}", f"{sensor2:.1f}", estado, '', ''])
             csv_file.flush()  # Asegurar escritura inmediata
         except Exception as e:
             print(f"Error al escribir en CSV: {e}")
 
+def log_block_to_csv(raw, filtered, estados, block_time):
+    """Registra un bloque de muestras con una sola escritura y un solo flush.
+
+    Cada fila recibe su propia marca de tiempo: la última muestra corresponde al momento
+    de lectura del bloque y las anteriores se espacian hacia atrás a 1/FILTER_SAMPLE_RATE_HZ.
+    """
+    if csv_writer is not None:
+        try:
+            period = timedelta(seconds=1.0 / FILTER_SAMPLE_RATE_HZ)
+            last = len(estados) - 1
+            csv_writer.writerows(
+                [(block_time - (last - i) * period).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3],
+                 f"{r[0]:.1f}", f"{r[1]:.1f}", estado, f"{f[0]:.1f}", f"{f[1]:.1f}"]
+                for i, (r, f, estado) in enumerate(zip(raw.tolist(), filtered.tolist(), estados))
+            )
+            csv_file.flush()
+        except Exception as e:
+            print(f"Error al escribir en CSV: {e}")
+
+def valid_readings_mask(raw):
+    """Retorna una máscara booleana con las lecturas válidas (distintas de 0 y dentro de rango)."""
+    return (raw != 0) & (raw <= MAX_VALID_READING_MM)
+
+class SignalFilterChain:
+    """Cadena de filtros aplicada por bloques de muestras con NumPy.
+
+    Cada bloque es un arreglo de forma (muestras, sensores). El estado de cada etapa
+    (historial de ventanas, estado de los IIR) se conserva entre bloques, por lo que
+    filtrar en bloques produce lo mismo que filtrar muestra a muestra.
+    """
+
+    STAGES = ('outliers', 'median', 'butterworth', 'kalman')
+
+    def __init__(self, chain, sample_rate, channels=2):
+        unknown = [stage for stage in chain if stage not in self.STAGES]
+        if unknown:
+            raise ValueError(f"Etapas de filtrado desconocidas: {unknown}. Disponibles: {self.STAGES}")
+        self.chain = list(chain)
+        self.channels = channels
+
+        # Coeficientes del Butterworth de 2º orden (transformación bilineal con prewarping)
+        k = np.tan(np.pi * BUTTERWORTH_CUTOFF_HZ / sample_rate)
+        norm = 1.0 / (1.0 + np.sqrt(2.0) * k + k * k)
+        b0 = k * k * norm
+        self.butterworth_b = np.array([b0, 2.0 * b0, b0])
+        self.butterworth_a = np.array([1.0, 2.0 * (k * k - 1.0) * norm, (1.0 - np.sqrt(2.0) * k + k * k) * norm])
+
+        # Kalman de velocidad constante: con Q y R fijos la ganancia converge en pocas
+        # muestras, así que se usa la ganancia de régimen permanente como un IIR de 2º orden
+        dt = 1.0 / sample_rate
+        q = KALMAN_PROCESS_NOISE ** 2
+        r = KALMAN_MEASUREMENT_NOISE ** 2
+        p00, p01, p11 = r, 0.0, q * dt * dt
+        for _ in range(1000):
+            # Predicción y corrección de la covarianza (ecuación de Riccati)
+            p00 = p00 + dt * (2.0 * p01 + dt * p11) + q * dt ** 4 / 4.0
+            p01 = p01 + dt * p11 + q * dt ** 3 / 2.0
+            p11 = p11 + q * dt * dt
+            k0, k1 = p00 / (p00 + r), p01 / (p00 + r)
+            p00, p01, p11 = (1.0 - k0) * p00, (1.0 - k0) * p01, p11 - k1 * p01
+        # x[n] = (I - K·H)·F·x[n-1] + K·z[n], salida = posición
+        a00, a01, a10, a11 = 1.0 - k0, (1.0 - k0) * dt, -k1, 1.0 - k1 * dt
+        self.kalman_b = np.array([k0, k1 * a01 - k0 * a11, 0.0])
+        self.kalman_a = np.array([1.0, -(a00 + a11), a00 * a11 - a01 * a10])
+        self.reset()
+
+    def reset(self):
+        """Descarta el estado acumulado (p. ej. tras una reconexión)."""
+        self.last_valid = np.zeros(self.channels)
+        # Sin referencia confirmada: la primera muestra no se da por buena hasta que otra la confirme
+        self.outlier_last = np.full(self.channels, np.nan)
+        self.outlier_confirmed = np.zeros(self.channels, dtype=bool)
+        self.outlier_gap = np.zeros(self.channels)
+        self.median_history = None
+        self.butterworth_state = None
+        self.kalman_state = None
+
+    def process(self, raw):
+        """Filtra un bloque (muestras, sensores) y retorna el bloque filtrado."""
+        x = self._hold_invalid(np.asarray(raw, dtype=float))
+        for stage in self.chain:
+            x = getattr(self, f'_{stage}')(x)
+        return x
+
+    def _hold_invalid(self, x):
+        # Reemplazar lecturas inválidas por la última válida (forward fill vectorizado)
+        valid = valid_readings_mask(x)
+        idx = np.where(valid, np.arange(len(x))[:, None], -1)
+        np.maximum.accumulate(idx, axis=0, out=idx)
+        filled = np.where(idx >= 0, x[np.maximum(idx, 0), np.arange(self.channels)], self.last_valid)
+        self.last_valid = filled[-1].copy()
+        return filled
+
+    @staticmethod
+    def _windows(history, x, window):
+        # Concatenar el historial del bloque anterior y generar ventanas deslizantes causales
+        if history is None:
+            history = np.repeat(x[:1], window - 1, axis=0)
+        extended = np.concatenate((history, x))
+        return sliding_window_view(extended, window, axis=0), extended[len(extended) - (window - 1):]
+
+    @staticmethod
+    def _iir(b, a, x, state):
+        # IIR de 2º orden con ganancia unitaria en continua; retorna (salida, estado)
+        if state is None:
+            # Estado inicial en régimen permanente para evitar el transitorio de arranque
+            state = np.stack(((1.0 - b[0]) * x[0], (b[2] - a[2]) * x[0]))
+        if lfilter is not None:
+            return lfilter(b, a, x, axis=0, zi=state)
+        # Camino lento sin scipy: forma directa II transpuesta muestra a muestra,
+        # vectorizada solo entre sensores
+        z1, z2 = state
+        y = np.empty_like(x)
+        for i, xi in enumerate(x):
+            yi = b[0] * xi + z1
+            z1 = b[1] * xi - a[1] * yi + z2
+            z2 = b[2] * xi - a[2] * yi
+            y[i] = yi
+        return y, np.stack((z1, z2))
+
+    def _outliers(self, x):
+        # Un valor es atípico si se aleja de la última muestra aceptada más de lo que la
+        # oscilación puede moverse en ese tiempo; se reemplaza por la última aceptada
+        # Caso común: ningún salto supera el límite, el bloque pasa sin cambios
+        previous = np.concatenate((self.outlier_last[None], x[:-1]))
+        if not self.outlier_gap.any() and (np.abs(x - previous) <= OUTLIER_MAX_STEP_MM).all():
+            self.outlier_last = x[-1].copy()
+            self.outlier_confirmed[:] = True
+            return x
+        last, confirmed, gap = self.outlier_last, self.outlier_confirmed, self.outlier_gap
+        y = np.empty_like(x)
+        for i, xi in enumerate(x):
+            # El límite crece con las muestras rechazadas para recuperarse de un salto real
+            near = np.abs(xi - last) <= (gap + 1.0) * OUTLIER_MAX_STEP_MM
+            # Una referencia sin confirmar (tras reset()) se reemplaza en lugar de rechazar
+            accepted = near | ~confirmed
+            confirmed = confirmed | near
+            last = np.where(accepted, xi, last)
+            gap = np.where(accepted, 0.0, gap + 1.0)
+            y[i] = last
+        self.outlier_last, self.outlier_confirmed, self.outlier_gap = last, confirmed, gap
+        return y
+
+    def _median(self, x):
+        windows, self.median_history = self._windows(self.median_history, x, MEDIAN_WINDOW)
+        return np.median(windows, axis=-1)
+
+    def _butterworth(self, x):
+        y, self.butterworth_state = self._iir(self.butterworth_b, self.butterworth_a, x,
+                                              self.butterworth_state)
+        return y
+
+    def _kalman(self, x):
+        y, self.kalman_state = self._iir(self.kalman_b, self.kalman_a, x, self.kalman_state)
+        return y
+
+signal_filter = SignalFilterChain(FILTER_CHAIN, FILTER_SAMPLE_RATE_HZ)
+
 # Función para limpiar recursos y salir del programa
 def cleanup_and_exit():
     """Cierra todas las conexiones y archivos, luego termina el programa."""
@@ -240,7 +435,7 @@ def cleanup_and_exit():
         try:
             # Registrar fin de sesión
             if csv_writer is not None:
-                csv_writer.writerow(['', '', '', 'Fin de sesion'])
+                csv_writer.writerow(['', '', '', 'Fin de sesion', '', ''])
             csv_file.close()
             # csv_filename está definida en el scope global del módulo
             try:
@@ -297,6 +492,15 @@ data2 = deque([0]*100, maxlen=100)
 line1, = ax.plot(data1, label="Sensor 1")
 line2, = ax.plot(data2, label="Sensor 2")
 
+# Señal sin filtrar (opcional), dibujada tenue detrás de la filtrada
+if PLOT_RAW:
+    raw_data1 = deque([0]*100, maxlen=100)
+    raw_data2 = deque([0]*100, maxlen=100)
+    raw_line1, = ax.plot(raw_data1, color=line1.get_color(), alpha=0.3, linewidth=0.8,
+                         label="Sensor 1 (sin filtrar)")
+    raw_line2, = ax.plot(raw_data2, color=line2.get_color(), alpha=0.3, linewidth=0.8,
+                         label="Sensor 2 (sin filtrar)")
+
 # Configurar eje Y centrado en 0
 ax.set_ylim(-75, 75)  # Rango inicial centrado en 0
 ax.set_ylabel("Distancia relativa (mm)")
@@ -416,12 +620,20 @@ while program_running:
             else:
                 # Reconexión exitosa
                 was_connected = True
+                signal_filter.reset()  # el firmware recalibra, descartar el estado anterior
                 if csv_writer is not None:
                     log_to_csv(current_d1, current_d2, f"Reconexion microcontrolador exitosa")
 
         # Intentar leer línea con timeout
         try:
             line = ser.readline().decode(errors='ignore').strip()
+            # Leer también las líneas que ya estén en el buffer para filtrarlas en bloque
+            lines = [line] if line else []
+            while line and len(lines) < FILTER_BLOCK_MAX and ser.in_waiting:
+                extra = ser.readline().decode(errors='ignore').strip()
+                if extra:
+                    lines.append(extra)
+            block_time = datetime.now()  # momento de lectura de la última línea del bloque
         except serial.SerialTimeoutException:
             # Timeout normal, continuar sin actualizar datos
             consecutive_errors = 0
@@ -509,113 +721,114 @@ while program_running:
         # Resetear contador de errores si recibimos datos
         consecutive_errors = 0
 
-        # Parsear datos
-        parts = line.split(',')
-        if len(parts) == 2:
-            try:
-                d1_raw = float(parts[0])
-                d2_raw = float(parts[1])
-
-                # Guardar valores originales para CSV antes de corrección
-                d1_original = d1_raw
-                d2_original = d2_raw
+        # Parsear datos (todas las líneas del bloque)
+        rows = []
+        for block_line in lines:
+            parts = block_line.split(',')
+            if len(parts) == 2:
+                try:
+                    rows.append((float(parts[0]), float(parts[1])))
+                except ValueError:
+                    # Error al parsear, ignorar esta línea
+                    pass
 
-                # Ignorar valores nulos o erróneos
-                # Si hay valores inválidos, usar el último valor válido si existe
-                if d1_raw == 0 or d1_raw > 8200:
-                    d1 = data1[-1] if len(data1) > 0 else 0
-                else:
-                    d1 = d1_raw
-                    
-                if d2_raw == 0 or d2_raw > 8200:
-                    d2 = data2[-1] if len(data2) > 0 else 0
-                else:
-                    d2 = d2_raw
-
-                # Guardar valores actuales (corregidos para gráfica)
-                current_d1 = d1
-                current_d2 = d2
-
-                data1.append(d1)
-                data2.append(d2)
-
-                line1.set_ydata(data1)
-                line2.set_ydata(data2)
-
-                # Actualizar límites del eje Y centrado en 0
-                ylim_changed = False
-                if len(data1) > 0 and len(data2) > 0:
-                    # Calcular rango de datos
-                    data_min = min(min(data1), min(data2))
-                    data_max = max(max(data1), max(data2))
-                    
-                    # Calcular el rango máximo (absoluto) para mantener el 0 centrado
-                    max_range = max(abs(data_min), abs(data_max)) + 50  # Margen de 50
-                    
-                    # Asegurar un mínimo razonable para el rango
-                    max_range = max(max_range, 10)  # Mínimo de ±100 mm
-                    
-                    # Limitar el rango máximo para evitar escalas excesivas
-                    max_range = min(max_range, 100)  # Máximo de ±1000 mm
-                    
-                    old_ylim = ax.get_ylim()
-                    new_ylim = (-max_range, max_range)
-                    
-                    if abs(old_ylim[0] - new_ylim[0]) > 10 or abs(old_ylim[1] - new_ylim[1]) > 10:
-                        ax.set_ylim(new_ylim)
-                        ylim_changed = True
-
-                # Actualizar textbox con valores actuales
-                textbox.set_text(f'Sensor 1: {current_d1:.1f} mm\n'
-                               f'Sensor 2: {current_d2:.1f} mm')
+        if rows:
+            # Valores originales para CSV; las lecturas inválidas se reemplazan dentro del filtro
+            raw_block = np.array(rows)
+            valid = valid_readings_mask(raw_block)
+            filtered_block = signal_filter.process(raw_block)
+
+            # Guardar valores actuales (filtrados para gráfica)
+            current_d1, current_d2 = filtered_block[-1].tolist()
+
+            data1.extend(filtered_block[:, 0].tolist())
+            data2.extend(filtered_block[:, 1].tolist())
+            line1.set_ydata(data1)
+            line2.set_ydata(data2)
+            if PLOT_RAW:
+                # Las lecturas inválidas quedan como huecos (NaN) en lugar de caídas a 0
+                raw_plot = np.where(valid, raw_block, np.nan)
+                raw_data1.extend(raw_plot[:, 0].tolist())
+                raw_data2.extend(raw_plot[:, 1].tolist())
+                raw_line1.set_ydata(raw_data1)
+                raw_line2.set_ydata(raw_data2)
+
+            # Actualizar límites del eje Y centrado en 0
+            ylim_changed = False
+            if len(data1) > 0 and len(data2) > 0:
+                # Calcular rango de datos
+                data_min = min(min(data1), min(data2))
+                data_max = max(max(data1), max(data2))
+                
+                # Calcular el rango máximo (absoluto) para mantener el 0 centrado
+                max_range = max(abs(data_min), abs(data_max)) + 50  # Margen de 50
+                
+                # Asegurar un mínimo razonable para el rango
+                max_range = max(max_range, 10)  # Mínimo de ±100 mm
+                
+                # Limitar el rango máximo para evitar escalas excesivas
+                max_range = min(max_range, 100)  # Máximo de ±1000 mm
+                
+                old_ylim = ax.get_ylim()
+                new_ylim = (-max_range, max_range)
+                
+                if abs(old_ylim[0] - new_ylim[0]) > 10 or abs(old_ylim[1] - new_ylim[1]) > 10:
+                    ax.set_ylim(new_ylim)
+                    ylim_changed = True
 
-                # Marcar como conectado si no lo estaba antes
-                if not was_connected:
-                    was_connected = True
-                    if csv_writer is not None:
-                        log_to_csv(d1_original, d2_original, "Reconexion microcontrolador exitosa")
+            # Actualizar textbox con valores actuales
+            textbox.set_text(f'Sensor 1: {current_d1:.1f} mm\n'
+                           f'Sensor 2: {current_d2:.1f} mm')
 
-                # Registrar datos en CSV usando valores originales
+            # Marcar como conectado si no lo estaba antes
+            if not was_connected:
+                was_connected = True
                 if csv_writer is not None:
-                    estado = "Normal"
-                    # Detectar posibles problemas con sensores (valores cero o fuera de rango)
-                    if d1_original == 0 or d1_original > 8200:
-                        estado = "Sensor1_invalido"
-                    if d2_original == 0 or d2_original > 8200:
-                        if estado == "Sensor1_invalido":
-                            estado = "Ambos_sensores_invalidos"
-                        else:
-                            estado = "Sensor2_invalido"
-                    log_to_csv(d1_original, d2_original, estado)
-
-                last_update_time = time.time()
-                needs_update = True
-                
-                # Actualización gráfica optimizada con blitting
-                current_time = time.time()
-                if current_time - last_graph_update >= GRAPH_UPDATE_INTERVAL or ylim_changed:
-                    if use_blitting and not ylim_changed:
-                        # Usar blitting para actualización rápida (solo las líneas)
-                        try:
-                            fig.canvas.restore_region(bg)
-                            ax.draw_artist(line1)
-                            ax.draw_artist(line2)
-                            ax.draw_artist(textbox)
-                            fig.canvas.blit(ax.bbox)
-                        except:
-                            # Si falla el blitting, hacer redibujado completo
-                            fig.canvas.draw()
-                            bg = fig.canvas.copy_from_bbox(ax.bbox)
+                    log_to_csv(raw_block[0, 0], raw_block[0, 1], "Reconexion microcontrolador exitosa")
+
+            # Registrar datos en CSV: valores originales y filtrados
+            if csv_writer is not None:
+                # Detectar posibles problemas con sensores (valores cero o fuera de rango)
+                estados = []
+                for valid1, valid2 in valid.tolist():
+                    if valid1 and valid2:
+                        estados.append("Normal")
+                    elif valid2:
+                        estados.append("Sensor1_invalido")
+                    elif valid1:
+                        estados.append("Sensor2_invalido")
                     else:
-                        # Redibujado completo (necesario cuando cambian los límites)
+                        estados.append("Ambos_sensores_invalidos")
+                log_block_to_csv(raw_block, filtered_block, estados, block_time)
+
+            last_update_time = time.time()
+            needs_update = True
+            
+            # Actualización gráfica optimizada con blitting
+            current_time = time.time()
+            if current_time - last_graph_update >= GRAPH_UPDATE_INTERVAL or ylim_changed:
+                if use_blitting and not ylim_changed:
+                    # Usar blitting para actualización rápida (solo las líneas)
+                    try:
+                        fig.canvas.restore_region(bg)
+                        if PLOT_RAW:
+                            ax.draw_artist(raw_line1)
+                            ax.draw_artist(raw_line2)
+                        ax.draw_artist(line1)
+                        ax.draw_artist(line2)
+                        ax.draw_artist(textbox)
+                        fig.canvas.blit(ax.bbox)
+                    except:
+                        # Si falla el blitting, hacer redibujado completo
                         fig.canvas.draw()
-                        if use_blitting:
-                            bg = fig.canvas.copy_from_bbox(ax.bbox)
-                    last_graph_update = current_time
-                    needs_update = False
-            except (ValueError, IndexError) as e:
-                # Error al parsear, ignorar esta línea
-                pass
+                        bg = fig.canvas.copy_from_bbox(ax.bbox)
+                else:
+                    # Redibujado completo (necesario cuando cambian los límites)
+                    fig.canvas.draw()
+                    if use_blitting:
+                        bg = fig.canvas.copy_from_bbox(ax.bbox)
+                last_graph_update = current_time
+                needs_update = False
 
         # Pausa mínima para mantener la gráfica viva
         plt.pause(0.001)  # Reducido de 0.01 para mejor rendimiento